@@ -64,7 +64,7 @@ def main():
     if process:
         with st.spinner("Processing"):
             if st.session_state["upload"][0] == "file" and st.session_state["upload"][1] is not None:
-                raw_text = utils.get_document_text(
+                raw_text = utils.iter_document_pages(
                     st.session_state["upload"][1], page_range=pages
                 )
             elif st.session_state["upload"][0] == "youtube" and st.session_state["upload"][1] is not None:
@@ -74,17 +74,23 @@ def main():
                 st.write(st.session_state["upload"])
                 st.error("No file uploaded")
                 st.stop()
+            preview = st.empty()
             try:
-                st.session_state["md_AI_output"] = st.session_state["worker"].get_note(raw_text, word_range, images)
+                note_stream = utils.SectionImageResolver(
+                    st.session_state["worker"].stream_note(
+                        raw_text, word_range, images, progress=utils.progress_callback()
+                    )
+                )
+                with preview.container():
+                    st.session_state["md_AI_output"] = st.write_stream(note_stream)
             except KeyError:
                 st.error(
                     "You don't have access to the selected model. [Get access here](/get_access)."
                 )
                 st.stop()
 
-            st.session_state["md_output"] = utils.md_image_format(
-                st.session_state["md_AI_output"]
-            )
+            st.session_state["md_output"] = note_stream.result()
+            preview.empty()
 
             st.success("Note Crafted!")
 
@@ -99,15 +105,11 @@ def main():
                 mime="text/markdown",
                 use_container_width=True,
             )
-            st.download_button(
+            utils.paper_download_button(
                 label="Download Paper Notes (PDF)",
-                data=utils.paper(
-                    header_text=st.session_state["file_name"],
-                    markdown_text=st.session_state["md_output"],
-                ),
                 file_name=f"{st.session_state['file_name']} - Notes.pdf",
-                mime="application/pdf",
-                use_container_width=True,
+                header_text=st.session_state["file_name"],
+                markdown_text=st.session_state["md_output"],
             )
 
         edit_mode = st.radio("Editing Mode", ["AI Edit", "Manual Edit"])
@@ -126,14 +128,15 @@ def main():
         if edit_mode == "AI Edit":
             usr_suggestion = st.chat_input("Edit the note so that...")
             if usr_suggestion:
-                st.session_state["md_AI_output"] = st.session_state["worker"].edit(
-                    task="edit_note",
-                    text=st.session_state["md_output"],
-                    request=usr_suggestion,
-                )
-                st.session_state["md_output"] = utils.md_image_format(
-                    st.session_state["md_AI_output"]
+                note_stream = utils.SectionImageResolver(
+                    st.session_state["worker"].stream_edit(
+                        task="edit_note",
+                        text=st.session_state["md_output"],
+                        request=usr_suggestion,
+                    )
                 )
+                st.session_state["md_AI_output"] = st.write_stream(note_stream)
+                st.session_state["md_output"] = note_stream.result()
                 st.rerun()
 
 
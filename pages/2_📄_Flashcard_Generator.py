@@ -67,23 +67,29 @@ def main():
     if process:
         with st.spinner("Processing"):
             if st.session_state["upload"][0] == "file" and st.session_state["upload"][1] is not None:
-                st.session_state.raw_text = utils.get_document_text(
+                raw_text = utils.iter_document_pages(
                     st.session_state["upload"][1], page_range=pages
                 )
             elif st.session_state["upload"][0] == "youtube" and st.session_state["upload"][1] is not None:
-                st.session_state.raw_text = utils.fetch_transcript(st.session_state["upload"][1])
+                raw_text = utils.fetch_transcript(st.session_state["upload"][1])
                 st.session_state["file_name"] = "NoteCraft Video Notes"
+            preview = st.empty()
             try:
-                st.session_state["f_output"] = st.session_state["worker"].get_flashcards(
-                    flashcard_range=flashcard_range,
-                    task=flashcard_type,
-                    transcript=st.session_state.raw_text,
-                )
+                with preview.container():
+                    st.session_state["f_output"] = st.write_stream(
+                        st.session_state["worker"].stream_flashcards(
+                            flashcard_range=flashcard_range,
+                            task=flashcard_type,
+                            transcript=raw_text,
+                            progress=utils.progress_callback(),
+                        )
+                    )
             except (KeyError, UnboundLocalError):
                 st.error(
                     "You don't have access to the selected model. [Get access here](/get_access)."
                 )
                 st.stop()
+            preview.empty()
 
     if "f_output" in st.session_state:
         utils.display_flashcards(st.session_state["f_output"])
@@ -94,15 +100,11 @@ def main():
             mime="text/csv",
             use_container_width=True,
         )
-        st.download_button(
+        utils.paper_download_button(
             label="Download Paper Flashcards (PDF)",
-            data=utils.paper(
-                header_text=st.session_state["file_name"],
-                flashcards=st.session_state["f_output"],
-            ),
             file_name=f"{st.session_state['file_name']} - Flashcards.pdf",
-            mime="application/pdf",
-            use_container_width=True,
+            header_text=st.session_state["file_name"],
+            flashcards=st.session_state["f_output"],
         )
 
 
@@ -110,10 +112,12 @@ def main():
             placeholder="Edit the flashcards so that..."
         )
         if usr_suggestion:
-            st.session_state["f_output"] = st.session_state["worker"].edit(
-                task="edit_flashcards",
-                request=usr_suggestion,
-                text=st.session_state["f_output"],
+            st.session_state["f_output"] = st.write_stream(
+                st.session_state["worker"].stream_edit(
+                    task="edit_flashcards",
+                    request=usr_suggestion,
+                    text=st.session_state["f_output"],
+                )
             )
 
             st.session_state["current_question_index"] = 0
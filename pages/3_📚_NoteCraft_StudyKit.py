@@ -34,16 +34,9 @@ def make_studykit(markdown_content, flashcards, encoded_pdf, page_range):
     markdown_content = markdown_content.replace("`", r"\`")
     flashcards = flashcards.replace("`", r"\`")
 
-    with open("NoteCraft-StudyKit.html", "r") as file:
-        html_template = file.read()
-
-    html_content = html_template.replace("***markdown_content***", markdown_content)
-    html_content = html_content.replace("***flashcards***", flashcards.strip())
-    html_content = html_content.replace("***encoded_pdf***", encoded_pdf)
-    html_content = html_content.replace("***page_range[0]***", str(page_range[0]))
-    html_content = html_content.replace("***page_range[1]***", str(page_range[1]))
-
-    return html_content
+    return utils.render_studykit(
+        markdown_content, flashcards.strip(), encoded_pdf, page_range
+    )
 
 
 def main():
@@ -113,17 +106,31 @@ def main():
                     st.write("Only one page in the document")
             if process:
                 with st.spinner("Processing"):
-                    raw_text = utils.get_document_text(
+                    raw_text = utils.iter_document_pages(
                         st.session_state["file"],
                         page_range=pages,
                     )
+                    preview = st.empty()
                     try:
-                        st.session_state["md_AI_output"] = st.session_state[
-                            "worker"
-                        ].get_note(raw_text, word_range, images)
-                        flashcard_output = st.session_state["worker"].get_flashcards(
-                            flashcard_range=flashcard_range, task=flashcard_type
+                        note_stream = utils.SectionImageResolver(
+                            st.session_state["worker"].stream_note(
+                                raw_text,
+                                word_range,
+                                images,
+                                progress=utils.progress_callback(),
+                            ),
+                            encoded=True,
                         )
+                        with preview.container():
+                            st.session_state["md_AI_output"] = st.write_stream(
+                                note_stream
+                            )
+                            flashcard_output = st.write_stream(
+                                st.session_state["worker"].stream_flashcards(
+                                    flashcard_range=flashcard_range,
+                                    task=flashcard_type,
+                                )
+                            )
 
                     except (KeyError, UnboundLocalError):
                         st.error(
@@ -131,17 +138,14 @@ def main():
                         )
                         st.stop()
 
-                    st.session_state["md_output"] = utils.md_image_format(
-                        (
-                            st.session_state["md_AI_output"]
-                        ),
-                        encoded=True,
-                    )
+                    st.session_state["md_output"] = note_stream.result()
+                    st.session_state["image_bytes_saved"] = note_stream.bytes_saved
+                    preview.empty()
                     st.session_state["flashcard_output"] = (
                         flashcard_output
                     )
                     st.session_state["raw_pdf"] = utils.get_base64_encoded_pdf(
-                        st.session_state["file"]
+                        st.session_state["file"], page_range=pages
                     )
                     st.session_state["output"] = make_studykit(
                         markdown_content=(st.session_state["md_output"]),
@@ -161,6 +165,10 @@ def main():
     ):
         st.markdown("# Notes:")
         st.markdown(st.session_state["md_output"], unsafe_allow_html=True)
+        if st.session_state.get("image_bytes_saved", 0) > 0:
+            st.caption(
+                f"Embedded images were compressed, saving {st.session_state['image_bytes_saved'] / 1024:.0f} KB."
+            )
         st.markdown("# Flashcards:")
         utils.display_flashcards(st.session_state["flashcard_output"])
         st.download_button(
@@ -170,16 +178,12 @@ def main():
             mime="application/studykit",
             use_container_width=True,
         )
-        st.download_button(
+        utils.paper_download_button(
             label="Download Paper Studykit (PDF)",
-            data=utils.paper(
-                header_text=st.session_state["file_name"],
-                markdown_text=st.session_state["md_output"],
-                flashcards=st.session_state["flashcard_output"],
-            ),
             file_name=f"{st.session_state['file_name']} - studykit.pdf",
-            mime="application/pdf",
-            use_container_width=True,
+            header_text=st.session_state["file_name"],
+            markdown_text=st.session_state["md_output"],
+            flashcards=st.session_state["flashcard_output"],
         )
         col1, col2 = st.columns([3, 1])
         edit_mode = col2.radio("Editing Mode", ["AI Edit", "Manual Edit"])
@@ -198,14 +202,15 @@ def main():
         if edit_mode == "AI Edit":
             usr_suggestion = col1.chat_input("Edit the note so that...")
             if usr_suggestion:
-                st.session_state["md_AI_output"] = st.session_state["worker"].edit(
-                    task="edit_note",
-                    text=st.session_state["md_output"],
-                    request=usr_suggestion,
-                )
-                st.session_state["md_output"] = utils.md_image_format(
-                    st.session_state["md_AI_output"]
+                note_stream = utils.SectionImageResolver(
+                    st.session_state["worker"].stream_edit(
+                        task="edit_note",
+                        text=st.session_state["md_output"],
+                        request=usr_suggestion,
+                    )
                 )
+                st.session_state["md_AI_output"] = st.write_stream(note_stream)
+                st.session_state["md_output"] = note_stream.result()
                 st.rerun()
 
             edit_what = col2.selectbox(label="Edit", options=["Note", "Flashcards"])
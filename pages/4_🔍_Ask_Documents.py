@@ -1,26 +1,30 @@
 import streamlit as st
-from langchain.text_splitter import CharacterTextSplitter
+import uuid
 from langchain_community.embeddings import OpenAIEmbeddings
-from langchain_community.vectorstores import FAISS
-from langchain.chains import create_history_aware_retriever, create_retrieval_chain
+from langchain.chains import create_retrieval_chain
 from langchain.chains.combine_documents import create_stuff_documents_chain
-from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
+from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder, PromptTemplate
+from langchain_core.runnables import RunnableBranch, ConfigurableField
+from langchain_core.output_parsers import StrOutputParser
 import utils
 from langchain_community.chat_models import ChatOpenAI
 from langchain_google_genai import GoogleGenerativeAIEmbeddings, GoogleGenerativeAI
 
 
-def get_conversation_chain(text):
-    text_splitter = CharacterTextSplitter(
-        separator="\n", chunk_size=1000, chunk_overlap=200, length_function=len
-    )
-    text_chunks = text_splitter.split_text(text)
+RETRIEVAL_MODES = ["Hybrid", "Semantic", "Keyword only"]
+EMBEDDING_BACKENDS = ["Provider", "Local"]
+DOCUMENT_PROMPT = "[{source}, page {page}]\n{page_content}"
+
 
+def get_conversation_chain(
+    library, retrieval="Hybrid", embedding_backend="Provider", added=None
+):
     if st.session_state["cookies"].get("model") == "GPT-4o-mini" and st.session_state[
         "cookies"
     ].get("OPENAI_API_KEY"):
+        embedding_model = "text-embedding-3-small"
         embeddings = OpenAIEmbeddings(
-            model="text-embedding-3-small",
+            model=embedding_model,
             api_key=st.session_state["cookies"]["OPENAI_API_KEY"],
         )
         llm = ChatOpenAI(
@@ -30,8 +34,9 @@ def get_conversation_chain(text):
     elif st.session_state["cookies"].get("model") == "Gemini-1.5" and st.session_state[
         "cookies"
     ].get("GOOGLE_API_KEY"):
+        embedding_model = "models/embedding-001"
         embeddings = GoogleGenerativeAIEmbeddings(
-            model="models/embedding-001",
+            model=embedding_model,
             google_api_key=st.session_state["cookies"]["GOOGLE_API_KEY"],
         )
         llm = GoogleGenerativeAI(
@@ -44,7 +49,30 @@ def get_conversation_chain(text):
         )
         return
 
-    vectorstore = FAISS.from_texts(texts=text_chunks, embedding=embeddings)
+    if embedding_backend == "Local":
+        embeddings = utils.HashingEmbeddings()
+        embedding_model = embeddings.model
+    else:
+        embeddings = utils.CachedEmbeddings(embeddings, embedding_model)
+
+    retriever = utils.HybridRetriever(
+        indexes={},
+        model=st.session_state["cookies"]["model"],
+        lexical=retrieval != "Semantic",
+        embeddings=embeddings if retrieval != "Keyword only" else None,
+        embedding_model=embedding_model,
+    )
+    # Chunks of this run's uploads are passed in, they may not have been stored.
+    added = added or {}
+    for doc_id in library.documents:
+        documents = added.get(doc_id) or library.chunks(doc_id)
+        if documents is None:
+            st.warning(
+                f"{library.documents[doc_id]['name']} has to be uploaded again to be searched."
+            )
+        else:
+            retriever.add_document(doc_id, documents)
+    st.session_state.retriever = retriever
 
     prompt = """
     You are a teacher that answers the students questions about the context they provide which is a PDF file, and you will reply in markdown and explain using easy terms, giving examples etc...
@@ -70,30 +98,84 @@ def get_conversation_chain(text):
             ("human", "{input}"),
         ]
     )
-    history_aware_retriever = create_history_aware_retriever(
-        llm, vectorstore.as_retriever(), contextualize_q_prompt
+    # Same as create_history_aware_retriever, but the LLM rewrite only runs when
+    # handle_user_input flags the question as a follow-up.
+    retriever = retriever.configurable_fields(
+        doc_ids=ConfigurableField(id="doc_ids"),
+        page_range=ConfigurableField(id="page_range"),
     )
+    history_aware_retriever = RunnableBranch(
+        (lambda x: not x.get("rewrite"), (lambda x: x["input"]) | retriever),
+        contextualize_q_prompt | llm | StrOutputParser() | retriever,
+    ).with_config(run_name="chat_retriever_chain")
 
-    document_chain = create_stuff_documents_chain(llm, qa_prompt)
+    document_chain = create_stuff_documents_chain(
+        llm, qa_prompt, document_prompt=PromptTemplate.from_template(DOCUMENT_PROMPT)
+    )
 
     conversation_chain = create_retrieval_chain(history_aware_retriever, document_chain)
 
     return conversation_chain
 
 
-def handle_user_input(user_prompt):
+def get_chat_memory():
+    """Recent turns within the model's history budget, after a summary of older turns.
+
+    Turns that fall out of the window are folded into the summary once, so the
+    prompt stays about the same size however long the chat gets.
+    """
+    history = st.session_state.chat_history
+    if not history:
+        return []
+    model = st.session_state["cookies"].get("model")
+    budget = utils.MODEL_LIMITS[model]["history_tokens"]
+    start = len(history)
+    while start > st.session_state.summarized_turns:
+        tokens = utils.count_tokens(str(history[start - 1]["content"]), model)
+        if tokens > budget:
+            break
+        budget -= tokens
+        start -= 1
+    # Keep question/answer pairs together.
+    start += start % 2
+    if start > st.session_state.summarized_turns:
+        st.session_state.history_summary = utils.LLMAgent(
+            st.session_state["cookies"]
+        ).summarize_chat(
+            st.session_state.history_summary,
+            history[st.session_state.summarized_turns : start],
+        )
+        st.session_state.summarized_turns = start
+
     chat_history = [
-        {"role": msg["role"], "content": str(msg["content"])}
-        for msg in st.session_state.chat_history
+        {"role": msg["role"], "content": str(msg["content"])} for msg in history[start:]
     ]
+    if st.session_state.history_summary:
+        chat_history.insert(
+            0,
+            {
+                "role": "system",
+                "content": f"Summary of the earlier conversation: {st.session_state.history_summary}",
+            },
+        )
+    return chat_history
+
+
+def handle_user_input(user_prompt, doc_ids=None, page_range=None):
+    chat_history = get_chat_memory()
+    rewrite = utils.needs_rewrite(user_prompt, chat_history)
 
     try:
         response = st.session_state.conversation.invoke(
-            {"input": user_prompt, "chat_history": chat_history}
+            {"input": user_prompt, "chat_history": chat_history, "rewrite": rewrite},
+            config={"configurable": {"doc_ids": doc_ids, "page_range": page_range}},
         )
     except AttributeError:
         st.chat_message("assistant").write("Please upload a PDF file and press process before you start chatting.")
         return
+    # Without history the stock retriever skipped the rewrite too.
+    if chat_history and not rewrite:
+        st.session_state.rewrites_saved += 1
     st.session_state.chat_history.append({"role": "user", "content": user_prompt})
     st.session_state.chat_history.append({"role": "ai", "content": response["answer"]})
 
@@ -111,7 +193,10 @@ def handle_user_input(user_prompt):
 
 def main():
     utils.universal_setup(
-        page_title="Ask My Document", page_icon="🔍", upload_file_types=["pdf", "docx", "pptx"]
+        page_title="Ask My Document",
+        page_icon="🔍",
+        upload_file_types=["pdf", "docx", "pptx"],
+        multiple_files=True,
     )
 
     if (
@@ -120,37 +205,98 @@ def main():
     ):
         st.write(
             """
-            This is a chatbot that answers students' questions based on the provided document.
+            This is a chatbot that answers students' questions based on your document library.
 
-            **How to use**: Just upload a **PDF, Word, or PowerPoint file**, press process, and start asking questions right away!
+            **How to use**: Just upload **PDF, Word, or PowerPoint files**, press process, and start asking questions right away! Processed files stay in your library for your next visit.
             """
         )
     if "conversation" not in st.session_state:
         st.session_state.conversation = None
     if "chat_history" not in st.session_state:
         st.session_state.chat_history = []
+        st.session_state.history_summary = ""
+        st.session_state.summarized_turns = 0
+        st.session_state.rewrites_saved = 0
+    if "library_id" not in st.session_state["cookies"]:
+        st.session_state["cookies"]["library_id"] = uuid.uuid4().hex
+        st.session_state["cookies"].save()
+    library = utils.Library(st.session_state["cookies"]["library_id"])
+
+    retrieval = st.sidebar.radio(
+        "Retrieval",
+        RETRIEVAL_MODES,
+        help="Keyword only answers without any embedding calls.",
+    )
+    embedding_backend = st.sidebar.radio(
+        "Embeddings",
+        EMBEDDING_BACKENDS,
+        help="Local embeds on this machine, without API calls or quota.",
+    )
     if st.sidebar.button("process", use_container_width=True):
-        if st.session_state.get("file") is None:
+        if not st.session_state.get("file") and not library.documents:
             st.chat_message("assistant").write("Please upload a PDF file first.")
         else:
             try:
                 with st.spinner("Processing"):
-                    # Extract text from pdf
-                    raw_text = utils.get_document_text(
-                        st.session_state["file"],
-                        page_range=None,
+                    # Rebuild only when the index settings change, new uploads
+                    # are indexed on their own.
+                    settings = (retrieval, embedding_backend, st.session_state["cookies"].get("model"))
+                    rebuild = (
+                        st.session_state.conversation is None
+                        or st.session_state.get("index_settings") != settings
                     )
+                    added = {}
+                    for file in st.session_state.get("file") or []:
+                        doc_id, documents = library.add(file)
+                        added[doc_id] = documents
+                        if not rebuild and doc_id not in st.session_state.retriever.indexes:
+                            st.session_state.retriever.add_document(doc_id, documents)
 
                     # Get conversation chain
-                    st.session_state.conversation = get_conversation_chain(raw_text)
+                    if rebuild:
+                        st.session_state.conversation = get_conversation_chain(
+                            library, retrieval, embedding_backend, added
+                        )
+                        st.session_state.index_settings = settings
                     st.success("Done! You can now start chatting.")
             except AttributeError:
                 st.error("Please upload a valid PDF file.")
                 return
 
+    doc_ids, page_range = None, None
+    if library.documents:
+        with st.sidebar.expander("Library", expanded=True):
+            for doc_id, document in list(library.documents.items()):
+                name, remove = st.columns([5, 1])
+                name.write(document["name"])
+                if remove.button("✕", key=f"remove_{doc_id}"):
+                    library.remove(doc_id)
+                    if st.session_state.conversation is not None:
+                        st.session_state.retriever.remove_document(doc_id)
+        doc_ids = st.sidebar.multiselect(
+            "Search in",
+            list(library.documents),
+            default=list(library.documents),
+            format_func=lambda doc_id: library.documents[doc_id]["name"],
+        )
+        max_pages = max(
+            (library.documents[doc_id]["pages"] for doc_id in doc_ids), default=1
+        )
+        if max_pages > 1:
+            pages = st.sidebar.slider(
+                "Only search these pages: ",
+                value=(1, max_pages),
+                min_value=1,
+                max_value=max_pages,
+            )
+            if pages != (1, max_pages):
+                page_range = pages
+
+    rewrites_saved = st.sidebar.empty()
     user_input = st.chat_input(placeholder="Ask me anything")
     if user_input:
-        handle_user_input(user_input)
+        handle_user_input(user_input, doc_ids, page_range)
+    rewrites_saved.metric("Rewrite calls saved", st.session_state.rewrites_saved)
 
 
 if __name__ == "__main__":
@@ -92,6 +92,13 @@ def main():
         f"Get a free API key from [Google AI studio](https://aistudio.google.com/app/apikey)."
     )
 
+    # The cache is shared by every session on this server, so it is only
+    # reported here, never cleared from the UI.
+    cache = utils.get_cache("llm_responses")
+    st.caption(
+        f"Server-wide response cache: {cache.hits} hits, {cache.misses} misses."
+    )
+
 
 if __name__ == "__main__":
     main()
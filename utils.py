@@ -2,12 +2,18 @@ import streamlit as st
 from st_cookies_manager import EncryptedCookieManager
 import csv
 import re
-from pdf2image import convert_from_bytes
+from pdf2image import convert_from_path
 import pytesseract
-from PyPDF2 import PdfReader
+from PyPDF2 import PdfReader, PdfWriter
+from PyPDF2.generic import NameObject, NumberObject
 from langchain_core.prompts import ChatPromptTemplate
+from langchain_core.embeddings import Embeddings
 from langchain_google_genai import GoogleGenerativeAI
-from langchain.text_splitter import RecursiveCharacterTextSplitter
+from langchain.text_splitter import RecursiveCharacterTextSplitter, CharacterTextSplitter
+from langchain_core.documents import Document as ChunkDocument
+from langchain_core.retrievers import BaseRetriever
+from langchain_community.vectorstores import FAISS
+import faiss
 import re
 from duckduckgo_search import DDGS
 from duckduckgo_search.exceptions import RatelimitException
@@ -19,13 +25,152 @@ import markdown
 import pdfkit
 from youtube_transcript_api import YouTubeTranscriptApi
 import time
+import os
+import json
+import sqlite3
+import hashlib
+import threading
+import functools
+import math
+import heapq
+import bisect
+import pickle
+import shutil
+from collections import Counter, defaultdict
+from typing import Any, Optional
+import zlib
+import tempfile
+import io
+from PIL import Image
+import numpy as np
+import tiktoken
 from pptx import Presentation
 from docx import Document
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
+from concurrent.futures import TimeoutError as FuturesTimeoutError
+from concurrent.futures.process import BrokenProcessPool
 
+# Per-provider limits for NoteForge, tune to the rate limits of your API tier.
+# chunk_tokens sizes the map step, reduce_tokens the input of each reduce call,
+# and context_tokens is the budget the joined summaries must fit before the
+# final note/flashcard call. history_tokens caps the recent Ask Documents turns
+# sent with each question, older turns are summarized.
+MODEL_LIMITS = {
+    "Gemini-1.5": {
+        "max_concurrency": 4,
+        "reduce_concurrency": 2,
+        "encoding": "cl100k_base",
+        "chunk_tokens": 800,
+        "reduce_tokens": 6000,
+        "context_tokens": 60000,
+        "history_tokens": 2000,
+    },
+    "GPT-4o-mini": {
+        "max_concurrency": 8,
+        "reduce_concurrency": 4,
+        "encoding": "o200k_base",
+        "chunk_tokens": 800,
+        "reduce_tokens": 6000,
+        "context_tokens": 30000,
+        "history_tokens": 2000,
+    },
+}
+
+# OCR runs on one process pool shared by every session, so max_workers also
+# caps the tesseract processes a multi-user server can spawn.
+OCR_SETTINGS = {
+    "max_workers": min(int(os.environ.get("NOTECRAFT_OCR_WORKERS", 4)), os.cpu_count() or 1),
+    "page_timeout": 120,
+    "max_run_pages": 20,
+    # Pages classified ahead of the consumer while extracting a PDF.
+    "classify_window": 16,
+    "raster_threads": 2,
+    "dpi": 300,
+    "grayscale": True,
+    # Image pages whose text layer is shorter or more garbled than this are OCRed.
+    "min_text_chars": 50,
+    "max_garbled_ratio": 0.1,
+    # "page" OCRs only pages without a usable text layer, "images" also OCRs
+    # the embedded images of pages that have one.
+    "ocr_mode": "page",
+}
+# OCR settings that change extracted text, and so are part of the page cache key.
+EXTRACTION_SETTINGS = ["dpi", "grayscale", "min_text_chars", "max_garbled_ratio", "ocr_mode"]
+
+# Image placeholders are resolved concurrently, backoff_budget is the total
+# number of seconds all workers of one note may spend waiting on rate limits.
+IMAGE_SETTINGS = {
+    "max_workers": 4,
+    "max_results": 5,
+    "timeout": 10,
+    "backoff_budget": 30,
+    # Embedded images are capped to what the StudyKit and paper layouts
+    # display (StudyKit caps images at 500px high) and re-encoded as JPEG,
+    # or PNG when they have transparency.
+    "max_size": (1000, 600),
+    "quality": 80,
+}
+
+# The StudyKit embeds only the selected pages of the source PDF, optionally
+# with their JPEG images downsampled to max_image_size.
+PDF_EMBED_SETTINGS = {
+    "downsample_images": True,
+    "max_image_size": (1600, 1600),
+    "quality": 75,
+}
+
+# Chunk embeddings are cached as packed arrays of dtype and new chunks are
+# sent to the provider in batches of its maximum batch size.
+EMBEDDING_SETTINGS = {
+    "dtype": "float16",
+    "batch_sizes": {"text-embedding-3-small": 2048, "models/embedding-001": 100},
+    "local_dimensions": 2048,
+}
+
+# Ask Documents chunking and retrieval.
+CHUNK_SETTINGS = {"chunk_size": 1000, "chunk_overlap": 200}
+# fetch_k candidates are taken from each index before reciprocal-rank fusion,
+# then picked by MMR, dropping near duplicates, until k chunks are picked or
+# context_tokens is used.
+RETRIEVAL_SETTINGS = {
+    "k": 6,
+    "context_tokens": 1200,
+    "fetch_k": 20,
+    "rrf_k": 60,
+    "mmr_lambda": 0.7,
+    "duplicate_overlap": 0.8,
+    "bm25_k1": 1.5,
+    "bm25_b": 0.75,
+}
+
+CACHE_DIR = os.environ.get("NOTECRAFT_CACHE_DIR", ".notecraft_cache")
+# Tables are checked against their limits after interval writes, or sooner when
+# the running totals pass a limit, and trimmed to target of each limit.
+CACHE_EVICTION = {"interval": 500, "target": 0.9}
+# Eviction settings for each DiskCache table, ttl is in seconds.
+CACHE_SETTINGS = {
+    "llm_responses": {"ttl": 30 * 24 * 3600, "max_entries": 5000, "max_bytes": 200 * 2**20},
+    "chunk_summaries": {"ttl": 90 * 24 * 3600, "max_entries": 50000, "max_bytes": 500 * 2**20},
+    "page_text": {"ttl": 30 * 24 * 3600, "max_bytes": 300 * 2**20},
+    "image_search": {"ttl": 7 * 24 * 3600, "max_entries": 20000},
+    "image_urls": {"ttl": 7 * 24 * 3600, "max_entries": 50000},
+    "image_bytes": {"max_bytes": 500 * 2**20},
+    "embeddings": {"max_bytes": 500 * 2**20},
+    "library_chunks": {"max_bytes": 500 * 2**20},
+}
+# Persisted FAISS indexes are directories, the least recently used ones are
+# removed once they take more than max_bytes.
+VECTORSTORE_CACHE = {"max_bytes": 2 * 2**30}
 
 
 def universal_setup(
-    page_title="Home", page_icon="📝", upload_file_types=[], yt_upload=False, worker=False
+    page_title="Home",
+    page_icon="📝",
+    upload_file_types=[],
+    yt_upload=False,
+    worker=False,
+    multiple_files=False,
 ):
     st.set_page_config(
         page_title=f"NoteCraft AI - {page_title}", page_icon=page_icon, layout="wide"
@@ -49,16 +194,563 @@ def universal_setup(
             )) if upload == "File" else ("youtube", st.sidebar.text_input("YouTube Video URL"))
         else:
             st.session_state["file"] = st.sidebar.file_uploader(
-                "upload your file", type=upload_file_types
+                "upload your file",
+                type=upload_file_types,
+                accept_multiple_files=multiple_files,
+            )
+
+
+
+@functools.lru_cache(maxsize=None)
+def _encoding(name):
+    # tiktoken downloads its BPE files on first use, None when that fails offline.
+    try:
+        return tiktoken.get_encoding(name)
+    except (requests.RequestException, OSError, ValueError):
+        return None
+
+
+def count_tokens(text, model):
+    encoding = _encoding(MODEL_LIMITS[model]["encoding"])
+    if encoding is None:
+        return len(text) // 4
+    return len(encoding.encode(text, disallowed_special=()))
+
+
+def as_text(transcript):
+    """Join the output of iter_document_pages, plain strings pass through."""
+    if isinstance(transcript, str):
+        return transcript
+    return "".join(page_text for _, page_text in transcript)
+
+
+def cache_key(*parts):
+    return hashlib.sha256(json.dumps(parts, default=str).encode("utf-8")).hexdigest()
+
+
+class DiskCache:
+    """SQLite key/value table with TTL expiry, LRU eviction and hit/miss counters."""
+
+    def __init__(self, table, ttl=None, max_entries=None, max_bytes=None):
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        self.table = table
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(
+            os.path.join(CACHE_DIR, "cache.sqlite3"),
+            check_same_thread=False,
+            timeout=30,
+        )
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            f"CREATE TABLE IF NOT EXISTS {table} "
+            "(key TEXT PRIMARY KEY, value BLOB, size INTEGER, created REAL, accessed REAL)"
+        )
+        self._conn.execute(
+            f"CREATE INDEX IF NOT EXISTS {table}_accessed ON {table} (accessed)"
+        )
+        self._conn.execute(f"CREATE INDEX IF NOT EXISTS {table}_created ON {table} (created)")
+        self._conn.commit()
+        # Running estimates, replaced keys are counted twice until the next pass.
+        self._entries, self._bytes = self._totals()
+        self._writes = 0
+
+    def get(self, key):
+        with self._lock:
+            row = self._conn.execute(
+                f"SELECT value, created FROM {self.table} WHERE key = ?", (key,)
+            ).fetchone()
+            now = time.time()
+            if row is None or (self.ttl and now - row[1] > self.ttl):
+                self.misses += 1
+                return None
+            self._conn.execute(
+                f"UPDATE {self.table} SET accessed = ? WHERE key = ?", (now, key)
+            )
+            self._conn.commit()
+            self.hits += 1
+            return row[0]
+
+    def set(self, key, value):
+        self.set_many([(key, value)])
+
+    def set_many(self, items):
+        """Write (key, value) pairs in one transaction."""
+        now = time.time()
+        rows = [
+            (key, value, len(value.encode("utf-8") if isinstance(value, str) else value), now, now)
+            for key, value in items
+        ]
+        with self._lock:
+            self._conn.executemany(
+                f"INSERT OR REPLACE INTO {self.table} VALUES (?, ?, ?, ?, ?)", rows
+            )
+            self._entries += len(rows)
+            self._bytes += sum(row[2] for row in rows)
+            self._writes += len(rows)
+            if (
+                (self.max_entries and self._entries > self.max_entries)
+                or (self.max_bytes and self._bytes > self.max_bytes)
+                or self._writes >= CACHE_EVICTION["interval"]
+            ):
+                self._evict(now)
+            self._conn.commit()
+
+    def _totals(self):
+        entries, size = self._conn.execute(
+            f"SELECT COUNT(*), COALESCE(SUM(size), 0) FROM {self.table}"
+        ).fetchone()
+        return entries, size
+
+    def _evict(self, now):
+        # Evict down to a fraction of each limit, so a full table isn't
+        # scanned again on the very next write.
+        if self.ttl:
+            self._conn.execute(
+                f"DELETE FROM {self.table} WHERE created < ?", (now - self.ttl,)
+            )
+        entries, size = self._totals()
+        if self.max_entries and entries > self.max_entries:
+            excess = entries - int(self.max_entries * CACHE_EVICTION["target"])
+            self._conn.execute(
+                f"DELETE FROM {self.table} WHERE key IN (SELECT key FROM {self.table} "
+                "ORDER BY accessed LIMIT ?)",
+                (excess,),
+            )
+            entries, size = self._totals()
+        if self.max_bytes and size > self.max_bytes:
+            excess = size - int(self.max_bytes * CACHE_EVICTION["target"])
+            self._conn.execute(
+                f"DELETE FROM {self.table} WHERE key IN (SELECT key FROM "
+                f"(SELECT key, size, SUM(size) OVER (ORDER BY accessed, key ROWS BETWEEN "
+                f"UNBOUNDED PRECEDING AND CURRENT ROW) AS freed FROM {self.table}) "
+                "WHERE freed - size < ?)",
+                (excess,),
+            )
+            entries, size = self._totals()
+        self._entries, self._bytes = entries, size
+        self._writes = 0
+
+    def clear(self):
+        with self._lock:
+            self._conn.execute(f"DELETE FROM {self.table}")
+            self._conn.commit()
+            self._entries, self._bytes = 0, 0
+        self.hits = 0
+        self.misses = 0
+
+
+@functools.lru_cache(maxsize=None)
+def get_cache(table):
+    return DiskCache(table, **CACHE_SETTINGS.get(table, {}))
+
+
+class CachedEmbeddings(Embeddings):
+    """Embeddings wrapper that only sends chunks missing from the embedding cache.
+
+    Vectors are stored per (model, dtype, chunk text) as packed numpy arrays.
+    """
+
+    def __init__(self, embeddings, model, dtype=None):
+        self.embeddings = embeddings
+        self.model = model
+        self.dtype = np.dtype(dtype or EMBEDDING_SETTINGS["dtype"])
+        self.cache = get_cache("embeddings")
+
+    def embed_documents(self, texts):
+        keys = [cache_key(self.model, self.dtype.name, text) for text in texts]
+        vectors = []
+        for key in keys:
+            vector = self.cache.get(key)
+            vectors.append(
+                None
+                if vector is None
+                else np.frombuffer(vector, dtype=self.dtype).astype(np.float32).tolist()
+            )
+        missing = [i for i, vector in enumerate(vectors) if vector is None]
+        batch_size = EMBEDDING_SETTINGS["batch_sizes"].get(self.model, 100)
+        for start in range(0, len(missing), batch_size):
+            batch = missing[start : start + batch_size]
+            for i, vector in zip(
+                batch, self.embeddings.embed_documents([texts[i] for i in batch])
+            ):
+                vectors[i] = vector
+            self.cache.set_many(
+                (keys[i], np.asarray(vectors[i], dtype=self.dtype).tobytes()) for i in batch
+            )
+        return vectors
+
+    def embed_query(self, text):
+        return self.embeddings.embed_query(text)
+
+
+class HashingEmbeddings(Embeddings):
+    """Local embeddings from signed feature hashing of word unigrams and bigrams.
+
+    Needs no model or API call, vectors are sublinear term counts, L2-normalized.
+    """
+
+    def __init__(self, dimensions=None):
+        self.dimensions = dimensions or EMBEDDING_SETTINGS["local_dimensions"]
+        self.model = f"local-hashing-{self.dimensions}"
+
+    @staticmethod
+    @functools.lru_cache(maxsize=2**16)
+    def _hash(word):
+        return zlib.crc32(word.encode("utf-8"))
+
+    def _embed(self, text):
+        words = np.fromiter(
+            map(self._hash, re.findall(r"\w+", text.lower())), dtype=np.uint64
+        )
+        bigrams = (words[:-1] * 0x9E3779B1 ^ words[1:]) & 0xFFFFFFFF
+        features, counts = np.unique(np.concatenate([words, bigrams]), return_counts=True)
+        signs = np.where(features & 2**31, 1.0, -1.0)
+        vector = np.bincount(
+            (features % self.dimensions).astype(np.intp),
+            weights=signs * (1 + np.log(counts)),
+            minlength=self.dimensions,
+        )
+        return (vector / (np.linalg.norm(vector) or 1.0)).tolist()
+
+    def embed_documents(self, texts):
+        return [self._embed(text) for text in texts]
+
+    def embed_query(self, text):
+        return self._embed(text)
+
+
+# Questions with one of these words, or shorter than FOLLOW_UP_MIN_WORDS, may use the
+# chat history and are rewritten into a standalone question before retrieval.
+FOLLOW_UP_WORDS = set(
+    "it its this that these those they them their he she him her above previous "
+    "earlier last same former latter also more else again another other "
+    "elaborate example examples continue".split()
+)
+FOLLOW_UP_MIN_WORDS = 4
+
+
+def needs_rewrite(question, chat_history):
+    if not chat_history:
+        return False
+    words = tokenize(question)
+    return len(words) < FOLLOW_UP_MIN_WORDS or not FOLLOW_UP_WORDS.isdisjoint(words)
+
+
+def tokenize(text):
+    return re.findall(r"\w+", text.lower())
+
+
+def overlap(terms, other_terms):
+    union = terms | other_terms
+    return len(terms & other_terms) / len(union) if union else 1.0
+
+
+class BM25Index:
+    """In-memory BM25 inverted index over chunk documents.
+
+    Document frequencies and the average chunk length can be taken from a whole
+    corpus of indexes, so scores from different documents are comparable.
+    """
+
+    def __init__(self, documents, k1=None, b=None):
+        self.k1 = k1 or RETRIEVAL_SETTINGS["bm25_k1"]
+        self.b = b or RETRIEVAL_SETTINGS["bm25_b"]
+        self.postings = defaultdict(dict)  # term -> {chunk index: term frequency}
+        self.lengths = []
+        for i, document in enumerate(documents):
+            terms = tokenize(document.page_content)
+            self.lengths.append(len(terms))
+            for term, frequency in Counter(terms).items():
+                self.postings[term][i] = frequency
+        self.total_length = sum(self.lengths)
+
+    def search(self, query, k, start=0, stop=None, corpus=None):
+        """(index, score) of the k best chunks among documents[start:stop]."""
+        stop = len(self.lengths) if stop is None else stop
+        corpus = corpus or [self]
+        n = sum(len(index.lengths) for index in corpus)
+        average_length = sum(index.total_length for index in corpus) / n if n else 1
+        scores = defaultdict(float)
+        for term in set(tokenize(query)):
+            postings = self.postings.get(term)
+            if not postings:
+                continue
+            document_frequency = sum(len(index.postings.get(term, ())) for index in corpus)
+            idf = math.log(1 + (n - document_frequency + 0.5) / (document_frequency + 0.5))
+            for i, frequency in postings.items():
+                if not start <= i < stop:
+                    continue
+                norm = 1 - self.b + self.b * self.lengths[i] / (average_length or 1)
+                scores[i] += idf * frequency * (self.k1 + 1) / (frequency + self.k1 * norm)
+        return heapq.nlargest(k, scores.items(), key=lambda item: item[1])
+
+
+class DocumentIndex:
+    """BM25 and FAISS indexes over the chunks of one document, in page order.
+
+    A page range is then a contiguous slice of chunk positions, and is searched
+    without touching the rest of the document.
+    """
+
+    def __init__(self, documents, lexical=None, vectorstore=None):
+        self.documents = documents
+        self.lexical = lexical
+        self.vectorstore = vectorstore
+
+    def positions(self, page_range):
+        if page_range is None:
+            return 0, len(self.documents)
+        first_page, last_page = page_range
+        page = lambda document: document.metadata["page"]
+        return (
+            bisect.bisect_left(self.documents, first_page, key=page),
+            bisect.bisect_right(self.documents, last_page, key=page),
+        )
+
+    def dense_search(self, vector, k, start, stop):
+        """(index, distance) of the k nearest chunks among documents[start:stop]."""
+        params = faiss.SearchParameters(sel=faiss.IDSelectorRange(start, stop))
+        distances, indices = self.vectorstore.index.search(vector, k, params=params)
+        return [(int(i), float(d)) for i, d in zip(indices[0], distances[0]) if i >= 0]
+
+
+class HybridRetriever(BaseRetriever):
+    """BM25 and/or FAISS results over the selected library documents, fused by
+    reciprocal rank, then packed into the context budget by MMR.
+
+    Scores from every document are merged into one ranking per index type before
+    fusion. Without embeddings no embedding calls are made.
+    """
+
+    indexes: dict  # doc_id -> DocumentIndex
+    model: str
+    lexical: bool = True
+    embeddings: Optional[Any] = None
+    embedding_model: Optional[str] = None
+    doc_ids: Optional[list] = None
+    page_range: Optional[tuple] = None
+    k: int = RETRIEVAL_SETTINGS["k"]
+    context_tokens: int = RETRIEVAL_SETTINGS["context_tokens"]
+    fetch_k: int = RETRIEVAL_SETTINGS["fetch_k"]
+    rrf_k: int = RETRIEVAL_SETTINGS["rrf_k"]
+    mmr_lambda: float = RETRIEVAL_SETTINGS["mmr_lambda"]
+    duplicate_overlap: float = RETRIEVAL_SETTINGS["duplicate_overlap"]
+
+    def add_document(self, doc_id, documents):
+        """Index one document's chunks, the other documents are left as they are."""
+        self.indexes[doc_id] = DocumentIndex(
+            documents,
+            lexical=BM25Index(documents) if self.lexical else None,
+            vectorstore=(
+                get_vectorstore(documents, self.embeddings, self.embedding_model)
+                if self.embeddings is not None
+                else None
+            ),
+        )
+
+    def remove_document(self, doc_id):
+        self.indexes.pop(doc_id, None)
+
+    def _get_relevant_documents(self, query, *, run_manager):
+        doc_ids = self.indexes if self.doc_ids is None else self.doc_ids
+        indexes = {doc_id: self.indexes[doc_id] for doc_id in doc_ids if doc_id in self.indexes}
+        vector = None
+        if self.embeddings is not None and indexes:
+            vector = np.array([self.embeddings.embed_query(query)], dtype=np.float32)
+        # BM25 statistics span every selected document, so scores are comparable.
+        corpus = [index.lexical for index in indexes.values() if index.lexical is not None]
+        lexical, dense = [], []
+        for doc_id, index in indexes.items():
+            start, stop = index.positions(self.page_range)
+            if index.lexical is not None:
+                for i, score in index.lexical.search(
+                    query, self.fetch_k, start, stop, corpus
+                ):
+                    lexical.append((-score, doc_id, i))
+            if vector is not None:
+                for i, distance in index.dense_search(vector, self.fetch_k, start, stop):
+                    dense.append((distance, doc_id, i))
+        scores = defaultdict(float)
+        for ranking in (lexical, dense):
+            for rank, (_, doc_id, i) in enumerate(heapq.nsmallest(self.fetch_k, ranking)):
+                scores[doc_id, i] += 1 / (self.rrf_k + rank + 1)
+        return [self.indexes[doc_id].documents[i] for doc_id, i in self._pack(scores)]
+
+    def _pack(self, scores):
+        if not scores:
+            return []
+        content = lambda key: self.indexes[key[0]].documents[key[1]].page_content
+        top_score = max(scores.values())
+        terms = {key: set(tokenize(content(key))) for key in scores}
+        redundancy = dict.fromkeys(scores, 0.0)
+        selected, budget = [], self.context_tokens
+        while redundancy and len(selected) < self.k:
+            best = max(
+                redundancy,
+                key=lambda key: self.mmr_lambda * scores[key] / top_score
+                - (1 - self.mmr_lambda) * redundancy[key],
             )
+            del redundancy[best]
+            tokens = count_tokens(content(best), self.model)
+            if tokens > budget:
+                continue
+            selected.append(best)
+            budget -= tokens
+            for key in list(redundancy):
+                redundancy[key] = max(redundancy[key], overlap(terms[key], terms[best]))
+                if redundancy[key] > self.duplicate_overlap:
+                    del redundancy[key]
+        return selected
 
 
+class Library:
+    """A user's document library: a manifest of the documents they added, and
+    the page-tagged chunks of each document.
+
+    Documents are keyed by the hash of the upload, and chunks and FAISS indexes
+    are cached per document, so adding or removing one never re-indexes the rest.
+    """
+
+    def __init__(self, library_id):
+        self.path = os.path.join(CACHE_DIR, "library", f"{library_id}.json")
+        self.documents = {}  # doc_id -> {"name": ..., "pages": ...}
+        if os.path.exists(self.path):
+            with open(self.path, encoding="utf-8") as file:
+                self.documents = json.load(file)
+        self.cache = get_cache("library_chunks")
+
+    def _save(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with tempfile.NamedTemporaryFile(
+            "w", dir=os.path.dirname(self.path), delete=False, encoding="utf-8"
+        ) as file:
+            json.dump(self.documents, file)
+        os.replace(file.name, self.path)
+
+    def _chunks_key(self, doc_id):
+        settings = [OCR_SETTINGS[key] for key in EXTRACTION_SETTINGS]
+        return cache_key(doc_id, CHUNK_SETTINGS, settings)
+
+    def add(self, file):
+        """Add an upload to the library, only documents without stored chunks are
+        extracted. Returns (doc_id, chunks)."""
+        doc_id = file_digest(file)
+        documents = self._load_chunks(doc_id)
+        if documents is None:
+            failed = []
+            documents = split_pages(iter_document_pages(file, page_range=None, failed=failed))
+            # Like page_text, chunks with pages that failed to OCR aren't kept, so
+            # the next add retries them.
+            if not failed:
+                self.cache.set(self._chunks_key(doc_id), pickle.dumps(documents))
+        if doc_id not in self.documents:
+            self.documents[doc_id] = {"name": file.name, "pages": page_count(file)}
+            self._save()
+        for document in documents:
+            document.metadata["source"] = self.documents[doc_id]["name"]
+        return doc_id, documents
+
+    def remove(self, doc_id):
+        # Chunks are shared by every library holding the same upload, they are
+        # left to the cache limits.
+        self.documents.pop(doc_id, None)
+        self._save()
+
+    def _load_chunks(self, doc_id):
+        data = self.cache.get(self._chunks_key(doc_id))
+        return None if data is None else pickle.loads(data)
+
+    def chunks(self, doc_id):
+        """Stored chunks of a document, None when they were evicted or never
+        stored and the document has to be uploaded again."""
+        documents = self._load_chunks(doc_id)
+        if documents is None:
+            return None
+        for document in documents:
+            document.metadata["source"] = self.documents[doc_id]["name"]
+        return documents
+
+
+def split_pages(pages):
+    """Chunks of every page, tagged with their page (or slide) number."""
+    text_splitter = CharacterTextSplitter(
+        separator="\n", length_function=len, **CHUNK_SETTINGS
+    )
+    return [
+        ChunkDocument(page_content=chunk, metadata={"page": page_num})
+        for page_num, page_text in pages
+        for chunk in text_splitter.split_text(page_text)
+    ]
+
+
+def get_vectorstore(documents, embeddings, embedding_model):
+    """FAISS index of the chunks, persisted per (chunks, embedding model)."""
+    content = "\0".join(
+        f"{document.metadata['page']}\0{document.page_content}" for document in documents
+    )
+    key = cache_key(
+        hashlib.sha256(content.encode("utf-8")).hexdigest(),
+        embedding_model,
+        CHUNK_SETTINGS,
+    )
+    path = os.path.join(CACHE_DIR, "faiss", key)
+    if os.path.exists(os.path.join(path, "index.faiss")):
+        os.utime(path)  # Marks the index as recently used for eviction.
+        # The index files are only ever written by get_vectorstore below.
+        return FAISS.load_local(path, embeddings, allow_dangerous_deserialization=True)
+
+    vectorstore = FAISS.from_documents(documents, embeddings)
+    # Save next to the final path and rename, so readers never see half an index.
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = tempfile.mkdtemp(dir=os.path.dirname(path))
+    vectorstore.save_local(tmp_path)
+    try:
+        os.replace(tmp_path, path)
+    except OSError:
+        shutil.rmtree(tmp_path, ignore_errors=True)
+    _evict_vectorstores(os.path.dirname(path))
+    return vectorstore
+
+
+def _evict_vectorstores(directory):
+    indexes = []
+    for entry in os.scandir(directory):
+        # Skips indexes still being written by get_vectorstore.
+        if entry.is_dir() and not entry.name.startswith("tmp"):
+            size = sum(file.stat().st_size for file in os.scandir(entry.path))
+            indexes.append((entry.stat().st_mtime, size, entry.path))
+    total = sum(size for _, size, _ in indexes)
+    for _, size, path in sorted(indexes):
+        if total <= VECTORSTORE_CACHE["max_bytes"]:
+            break
+        shutil.rmtree(path, ignore_errors=True)
+        total -= size
+
+
+def progress_callback(text="NoteForge"):
+    bar = st.empty()
+
+    def update(done, total):
+        bar.progress(
+            done / total if total else 1.0,
+            text=f"{text}: {done}/{total} chunks summarized",
+        )
+
+    return update
+
 
 class LLMAgent:
     def __init__(self, cookies):
         self.cookies = cookies
         self.model = self.cookies["model"] if "model" in self.cookies else None
         self.llm = self._initialize_llm()
+        self.cache = get_cache("llm_responses")
+        self.summaries = get_cache("chunk_summaries")
 
     def _initialize_llm(self):
         if self.model == "Gemini-1.5":
@@ -78,7 +770,7 @@ class LLMAgent:
             st.stop()
         return llm
 
-    def _get_chain(self, task):
+    def _get_prompt(self, task):
         task_prompts = {
             "note_w_images": ChatPromptTemplate.from_messages(
                 [
@@ -115,6 +807,15 @@ class LLMAgent:
                     ),
                 ]
             ),
+            "chat_summary": ChatPromptTemplate.from_messages(
+                [
+                    (
+                        "system",
+                        "Update the summary of a conversation between a student and a teacher about a document with the new messages. Keep the questions asked, the answers given and any facts the student may refer back to, in at most 200 words. Only return the updated summary.\nCurrent summary: {summary}",
+                    ),
+                    ("user", "{messages}"),
+                ]
+            ),
             "edit_flashcards": ChatPromptTemplate.from_messages(
                 [
                     (
@@ -158,221 +859,837 @@ class LLMAgent:
         prompt = task_prompts.get(task)
         if prompt is None:
             raise ValueError(f"Task '{task}' not found in task_prompts.")
-        return prompt | self.llm
+        return prompt
 
-    def get_note(self, transcript, word_range: tuple, images=False):
-        note_prompt = self._get_chain("note" if not images else "note_w_images")
-        if st.session_state["cookies"]["NoteForge"] == "True":
-            text_splitter = RecursiveCharacterTextSplitter(
-                chunk_size=3000,
-                chunk_overlap=200,
-                separators=["\n", ".", "!", "?"],
-            )
-            transcript = text_splitter.split_text(transcript)
-            page_notes_chain = self._get_chain("page_note")
-            try:
-                final_transcript = "\n".join(
-                    (
-                        page_notes_chain.invoke({"transcript": doc})
-                        if st.session_state["cookies"]["model"] == "Gemini-1.5"
-                        else page_notes_chain.invoke({"transcript": doc}).content
-                    )
-                    for doc in transcript
-                )
-            except ResourceExhausted:
-                st.error(
-                    "API Exhausted, if you are using the free version of the API, you may have reached the limit.\nTry again later.\nIf NoteForge is enabled, try disabling it."
-                )
-                st.stop()
-        else:
-            final_transcript = transcript
+    def _run(self, task, inputs, cache=True):
+        prompt_value = self._get_prompt(task).invoke(inputs)
+        key = cache_key(self.model, prompt_value.to_string())
+        cached = self.cache.get(key) if cache else None
+        if cached is not None:
+            return cached
+        response = self.llm.invoke(prompt_value)
+        response = str(response) if self.model == "Gemini-1.5" else str(response.content)
+        if cache:
+            self.cache.set(key, response)
+        return response
+
+    def _summarize_chunks(self, chunks, progress=None, max_workers=None):
+        # Summaries are stored per (model, chunk text), so every page and every
+        # rerun with other final-stage settings only pays for unseen chunks.
+        # chunks may be a lazy iterable, calls start as soon as a chunk arrives.
+        keys = []
+        summaries = []
+        futures = {}
+
+        def collect(future):
+            i = futures.pop(future)
+            summaries[i] = future.result()
+            self.summaries.set(keys[i], summaries[i])
+            if progress:
+                progress(len(summaries) - len(futures), len(summaries))
+
+        executor = ThreadPoolExecutor(
+            max_workers=max_workers or MODEL_LIMITS[self.model]["max_concurrency"]
+        )
         try:
+            for i, doc in enumerate(chunks):
+                keys.append(cache_key(self.model, doc))
+                summaries.append(self.summaries.get(keys[i]))
+                if summaries[i] is None:
+                    futures[
+                        executor.submit(
+                            self._run, "page_note", {"transcript": doc}, cache=False
+                        )
+                    ] = i
+                for future in [future for future in futures if future.done()]:
+                    collect(future)
+            if progress:
+                progress(len(summaries) - len(futures), len(summaries))
+            for future in as_completed(list(futures)):
+                collect(future)
+        except BaseException:
+            # Don't send the queued calls once one has failed, e.g. on quota.
+            executor.shutdown(wait=False, cancel_futures=True)
+            raise
+        executor.shutdown()
+        return summaries
 
-            self.note = note_prompt.invoke(
-                {
-                    "transcript": final_transcript,
-                    "word_range": " to ".join(map(str, word_range)),
-                }
+    def _reduce(self, summaries, progress=None):
+        limits = MODEL_LIMITS[self.model]
+        sizes = [count_tokens(summary, self.model) for summary in summaries]
+        while len(summaries) > 1 and sum(sizes) > limits["context_tokens"]:
+            # Every group holds at least two summaries, so each level at
+            # least halves the count and the tree depth stays logarithmic.
+            groups = [[]]
+            group_size = 0
+            for summary, size in zip(summaries, sizes):
+                if len(groups[-1]) >= 2 and group_size + size > limits["reduce_tokens"]:
+                    groups.append([])
+                    group_size = 0
+                groups[-1].append(summary)
+                group_size += size
+            if len(groups) > 1 and len(groups[-1]) == 1:
+                groups[-2].extend(groups.pop())
+            summaries = self._summarize_chunks(
+                ["\n".join(group) for group in groups],
+                progress,
+                max_workers=limits["reduce_concurrency"],
             )
+            sizes = [count_tokens(summary, self.model) for summary in summaries]
+        return summaries
+
+    def _iter_chunks(self, transcript):
+        limits = MODEL_LIMITS[self.model]
+        text_splitter = RecursiveCharacterTextSplitter.from_tiktoken_encoder(
+            encoding_name=limits["encoding"],
+            chunk_size=limits["chunk_tokens"],
+            chunk_overlap=50,
+            separators=["\n", ".", "!", "?"],
+        )
+        if isinstance(transcript, str):
+            yield from text_splitter.split_text(transcript)
+            return
+        # The last chunk of the buffer may still grow with the next page,
+        # so it is carried over instead of being emitted.
+        buffer = ""
+        for _, page_text in transcript:
+            chunks = text_splitter.split_text(buffer + page_text)
+            yield from chunks[:-1]
+            buffer = chunks[-1] if chunks else ""
+        if buffer:
+            yield buffer
+
+    def _noteforge(self, transcript, progress=None):
+        try:
+            summaries = self._summarize_chunks(self._iter_chunks(transcript), progress)
+            return "\n".join(self._reduce(summaries, progress))
         except ResourceExhausted:
             st.error(
                 "API Exhausted, if you are using the free version of the API, you may have reached the limit.\nTry again later.\nIf NoteForge is enabled, try disabling it."
             )
             st.stop()
-        return str(self.note) if st.session_state["cookies"]["model"] == "Gemini-1.5" else str(self.note.content)
 
-    def get_flashcards(
-        self, flashcard_range: tuple, task="Term --> Definition", transcript=None
-    ):
+    def _note_request(self, transcript, word_range, images, progress):
+        if st.session_state["cookies"]["NoteForge"] == "True":
+            final_transcript = self._noteforge(transcript, progress)
+        else:
+            final_transcript = as_text(transcript)
+        return "note" if not images else "note_w_images", {
+            "transcript": final_transcript,
+            "word_range": " to ".join(map(str, word_range)),
+        }
+
+    def _flashcards_request(self, flashcard_range, task, transcript, progress):
         if (
             st.session_state["cookies"]["NoteForge"] == "True"
             and transcript is not None
         ):
-            text_splitter = RecursiveCharacterTextSplitter(
-                chunk_size=3000,
-                chunk_overlap=200,
-                separators=["\n", ".", "!", "?"],
-            )
-            transcript = text_splitter.split_text(transcript)
-            page_notes_chain = self._get_chain("page_note")
-            flashcard_chain = self._get_chain(task)
-            try:
-                final_transcript = "\n".join(
-                    (
-                        page_notes_chain.invoke({"transcript": doc})
-                        if st.session_state["cookies"]["model"] == "Gemini-1.5"
-                        else page_notes_chain.invoke({"transcript": doc}).content
-                    )
-                    for doc in transcript
-                )
-            except ResourceExhausted:
-                st.error(
-                    "API Exhausted, if you are using the free version of the API, you may have reached the limit.\nTry again later.\nIf NoteForge is enabled, try disabling it."
-                )
-                st.stop()
+            final_transcript = self._noteforge(transcript, progress)
         elif transcript is None:
             final_transcript = self.note
         elif transcript is not None:
-            final_transcript = transcript
+            final_transcript = as_text(transcript)
+        return task, {
+            "transcript": final_transcript,
+            "flashcard_range": " to ".join(map(str, flashcard_range)),
+        }
+
+    def _stream(self, task, inputs):
+        prompt_value = self._get_prompt(task).invoke(inputs)
+        key = cache_key(self.model, prompt_value.to_string())
+        cached = self.cache.get(key)
+        if cached is not None:
+            yield cached
+            return
+        response = ""
         try:
-            flashcard_chain = self._get_chain(task)
-            self.flashcards = flashcard_chain.invoke(
-                {
-                    "transcript": final_transcript,
-                    "flashcard_range": " to ".join(map(str, flashcard_range)),
-                }
+            for chunk in self.llm.stream(prompt_value):
+                chunk = str(chunk) if self.model == "Gemini-1.5" else str(chunk.content)
+                response += chunk
+                yield chunk
+        except ResourceExhausted:
+            st.error(
+                "API Exhausted, if you are using the free version of the API, you may have reached the limit.\nTry again later.\nIf NoteForge is enabled, try disabling it."
             )
+            st.stop()
+        self.cache.set(key, response)
+
+    def get_note(self, transcript, word_range: tuple, images=False, progress=None):
+        task, inputs = self._note_request(transcript, word_range, images, progress)
+        try:
+            self.note = self._run(task, inputs)
         except ResourceExhausted:
             st.error(
                 "API Exhausted, if you are using the free version of the API, you may have reached the limit.\nTry again later.\nIf NoteForge is enabled, try disabling it."
             )
             st.stop()
-        return str(self.flashcards) if st.session_state["cookies"]["model"] == "Gemini-1.5" else str(self.flashcards.content)
+        return self.note
+
+    def stream_note(self, transcript, word_range: tuple, images=False, progress=None):
+        task, inputs = self._note_request(transcript, word_range, images, progress)
+        self.note = ""
+        for chunk in self._stream(task, inputs):
+            self.note += chunk
+            yield chunk
+
+    def get_flashcards(
+        self,
+        flashcard_range: tuple,
+        task="Term --> Definition",
+        transcript=None,
+        progress=None,
+    ):
+        task, inputs = self._flashcards_request(
+            flashcard_range, task, transcript, progress
+        )
+        try:
+            self.flashcards = self._run(task, inputs)
+        except ResourceExhausted:
+            st.error(
+                "API Exhausted, if you are using the free version of the API, you may have reached the limit.\nTry again later.\nIf NoteForge is enabled, try disabling it."
+            )
+            st.stop()
+        return self.flashcards
+
+    def stream_flashcards(
+        self,
+        flashcard_range: tuple,
+        task="Term --> Definition",
+        transcript=None,
+        progress=None,
+    ):
+        task, inputs = self._flashcards_request(
+            flashcard_range, task, transcript, progress
+        )
+        self.flashcards = ""
+        for chunk in self._stream(task, inputs):
+            self.flashcards += chunk
+            yield chunk
 
     def edit(self, task, request, text):
-        edit_chain = self._get_chain(task)
         try:
-            return str(edit_chain.invoke({"request": request, "text": text}).content)
+            return self._run(task, {"request": request, "text": text})
         except ResourceExhausted:
             st.error(
                 "API Exhausted, if you are using the free version of the API, you may have reached the limit.\nTry again later.\nIf NoteForge is enabled, try disabling it."
             )
             st.stop()
 
+    def stream_edit(self, task, request, text):
+        return self._stream(task, {"request": request, "text": text})
+
+    def summarize_chat(self, summary, messages):
+        """Fold older chat messages into the rolling conversation summary."""
+        messages = "\n".join(f"{msg['role']}: {msg['content']}" for msg in messages)
+        try:
+            return self._run(
+                "chat_summary", {"summary": summary or "None", "messages": messages}
+            )
+        except ResourceExhausted:
+            st.error(
+                "API Exhausted, if you are using the free version of the API, you may have reached the limit.\nTry again later."
+            )
+            st.stop()
+
+
+class SectionImageResolver:
+    """Pass-through for a streamed markdown note that resolves the image
+    placeholders of every finished section in the background."""
+
+    def __init__(self, stream, encoded=False):
+        self.stream = stream
+        self.encoded = encoded
+        self._executor = ThreadPoolExecutor(max_workers=2)
+        # One backoff budget and one search pool for the whole note, not per section.
+        self._backoff = _SharedBackoff(IMAGE_SETTINGS["backoff_budget"])
+        self._image_executor = ThreadPoolExecutor(max_workers=IMAGE_SETTINGS["max_workers"])
+        self._sections = []
+        self._buffer = ""
+        self.bytes_saved = 0
+
+    def _submit(self, section):
+        stats = {"bytes_saved": 0}
+        self._sections.append(
+            (
+                self._executor.submit(
+                    _md_image_format,
+                    section,
+                    self.encoded,
+                    stats,
+                    self._backoff,
+                    self._image_executor,
+                ),
+                stats,
+            )
+        )
+
+    def __iter__(self):
+        for chunk in self.stream:
+            self._buffer += chunk
+            boundary = self._buffer.rfind("\n#")
+            # Only cut on a header that isn't inside an unfinished <<placeholder>>.
+            if boundary > 0 and self._buffer.rfind(
+                "<<", 0, boundary
+            ) <= self._buffer.rfind(">>", 0, boundary):
+                self._submit(self._buffer[: boundary + 1])
+                self._buffer = self._buffer[boundary + 1 :]
+            yield chunk
+        self._submit(self._buffer)
+        self._buffer = ""
+
+    def result(self):
+        # Workers have no script context, so the rate limit is reported here.
+        try:
+            md = "".join(section.result() for section, _ in self._sections)
+        except RatelimitException:
+            st.error("Rate limit exceeded. Please try again later.")
+            st.stop()
+        finally:
+            self._executor.shutdown(cancel_futures=True)
+            self._image_executor.shutdown(cancel_futures=True)
+        self.bytes_saved = sum(stats["bytes_saved"] for _, stats in self._sections)
+        return md
+
 
 from duckduckgo_search.exceptions import RatelimitException
 
-def md_image_format(md, encoded=False):
-    def replace_with_image(match):
-        description = match.group(1).strip()
-        retry_attempts = 5
-        for attempt in range(retry_attempts):
-            try:
-                results = ddgs.images(keywords=description, max_results=5)
-                for result in results:
-                    image_url = result["image"]
-                    if encoded:
-                        try:
-                            response = requests.get(image_url)
-                            response.raise_for_status()
-                            image_data = response.content
-                            image_format = image_url.split(".")[-1]
-                            base64_image = base64.b64encode(image_data).decode("utf-8")
-                            return f"![{description}](data:image/{image_format};base64,{base64_image})"
-                        except requests.RequestException as e:
-                            continue
-                    else:
-                        return f"![{description}]({image_url})"
-                return "\n"
-            except RatelimitException:
-                if attempt < retry_attempts - 1:
-                    time.sleep(2 ** attempt)  # Exponential backoff
-                else:
-                    st.error("Rate limit exceeded. Please try again later.")
-                    st.stop()
 
+@functools.lru_cache(maxsize=None)
+def _get_http_session():
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(
+        pool_connections=IMAGE_SETTINGS["max_workers"],
+        pool_maxsize=IMAGE_SETTINGS["max_workers"] * 2,
+    )
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+class _SharedBackoff:
+    """Exponential backoff shared by every worker of one md_image_format call."""
+
+    def __init__(self, budget):
+        self.budget = budget
+        self.delay = 1
+        self.not_before = 0
+        self._lock = threading.Lock()
+
+    def wait(self):
+        delay = self.not_before - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+
+    def rate_limited(self):
+        """Push every worker back, returns False once the budget is spent."""
+        with self._lock:
+            if self.budget <= 0:
+                return False
+            delay = min(self.delay, self.budget)
+            self.budget -= delay
+            self.delay *= 2
+            self.not_before = max(self.not_before, time.monotonic() + delay)
+            return True
+
+
+def _search_images(description, backoff):
+    cache = get_cache("image_search")
+    key = cache_key(" ".join(re.findall(r"\w+", description.lower())))
+    cached = cache.get(key)
+    if cached is not None:
+        return json.loads(cached)
+    while True:
+        backoff.wait()
+        try:
+            results = DDGS().images(
+                keywords=description, max_results=IMAGE_SETTINGS["max_results"]
+            )
+            break
+        except RatelimitException:
+            if not backoff.rate_limited():
+                raise
+    image_urls = [result["image"] for result in results]
+    cache.set(key, json.dumps(image_urls))
+    return image_urls
+
+
+def _fetch_image(image_url):
+    """Download an image through the url -> sha256 -> bytes disk cache."""
+    urls = get_cache("image_urls")
+    images = get_cache("image_bytes")
+    digest = urls.get(image_url)
+    image_data = images.get(digest) if digest is not None else None
+    if image_data is not None:
+        return image_data
+    response = _get_http_session().get(image_url, timeout=IMAGE_SETTINGS["timeout"])
+    response.raise_for_status()
+    digest = hashlib.sha256(response.content).hexdigest()
+    images.set(digest, response.content)
+    urls.set(image_url, digest)
+    return response.content
+
+
+def _normalize_image(image_data):
+    """Sniff, downscale and re-encode an image for embedding as a data URI.
+
+    Returns (bytes, mime subtype), or None when the data isn't an image.
+    """
+    if image_data.lstrip()[:5] in (b"<svg ", b"<?xml"):
+        return image_data, "svg+xml"
+    try:
+        image = Image.open(io.BytesIO(image_data))
+        image.load()
+    except (OSError, ValueError, Image.DecompressionBombError):
+        return None
+    image_format = (image.format or "png").lower()
+    if getattr(image, "is_animated", False):
+        return image_data, image_format
+
+    output = io.BytesIO()
+    try:
+        image.thumbnail(IMAGE_SETTINGS["max_size"])
+        if image.mode in ("RGBA", "LA", "P") and (
+            image.mode != "P" or "transparency" in image.info
+        ):
+            image.save(output, format="PNG", optimize=True)
+            normalized = output.getvalue(), "png"
+        else:
+            image.convert("RGB").save(
+                output, format="JPEG", quality=IMAGE_SETTINGS["quality"], optimize=True
+            )
+            normalized = output.getvalue(), "jpeg"
+    except (OSError, ValueError):
+        # Modes Pillow can't convert (e.g. 16-bit greyscale) are embedded as is.
+        return image_data, image_format
+    if len(normalized[0]) >= len(image_data) and image_format in (
+        "png",
+        "jpeg",
+        "gif",
+        "webp",
+    ):
+        return image_data, image_format
+    return normalized
+
+
+def _resolve_image(description, encoded, backoff):
+    """Returns the markdown for a placeholder and the bytes saved by normalizing it."""
+    for image_url in _search_images(description, backoff):
+        if not encoded:
+            return f"![{description}]({image_url})", 0
+        try:
+            image_data = _fetch_image(image_url)
+        except requests.RequestException:
+            continue
+        normalized = _normalize_image(image_data)
+        if normalized is None:
+            continue
+        base64_image = base64.b64encode(normalized[0]).decode("utf-8")
+        return (
+            f"![{description}](data:image/{normalized[1]};base64,{base64_image})",
+            len(image_data) - len(normalized[0]),
+        )
+    return "\n", 0
+
+
+def md_image_format(md, encoded=False, stats=None):
+    try:
+        return _md_image_format(md, encoded, stats)
+    except RatelimitException:
+        st.error("Rate limit exceeded. Please try again later.")
+        st.stop()
+
+
+def _md_image_format(md, encoded=False, stats=None, backoff=None, executor=None):
+    """md_image_format without the error UI, raises RatelimitException.
+
+    backoff and executor can be shared by several calls, e.g. the sections of
+    one streamed note, otherwise each call gets its own.
+    """
     pattern = r"<<\s*(.*?)\s*>>"
-    ddgs = DDGS()
-    modified_md = re.sub(pattern, replace_with_image, str(md), flags=re.DOTALL)
-    return modified_md
+    md = str(md)
+    descriptions = list(
+        dict.fromkeys(
+            description.strip()
+            for description in re.findall(pattern, md, flags=re.DOTALL)
+        )
+    )
+    if not descriptions:
+        return md
 
+    backoff = backoff or _SharedBackoff(IMAGE_SETTINGS["backoff_budget"])
+    resolve = lambda description: _resolve_image(description, encoded, backoff)
+    if executor is not None:
+        images = dict(zip(descriptions, executor.map(resolve, descriptions)))
+    else:
+        with ThreadPoolExecutor(
+            max_workers=min(len(descriptions), IMAGE_SETTINGS["max_workers"])
+        ) as executor:
+            images = dict(zip(descriptions, executor.map(resolve, descriptions)))
+    if stats is not None:
+        stats["bytes_saved"] = sum(saved for _, saved in images.values())
+    return re.sub(
+        pattern, lambda match: images[match.group(1).strip()][0], md, flags=re.DOTALL
+    )
 
-def get_base64_encoded_pdf(file):
+def _downsample_page_images(page):
+    """Shrink the JPEG images of a page in place, other encodings are left as is."""
+    if "/XObject" not in page["/Resources"]:
+        return
+    xObject = page["/Resources"]["/XObject"].get_object()
+    for obj in xObject:
+        image_object = xObject[obj].get_object()
+        if (
+            image_object["/Subtype"] != "/Image"
+            or image_object.get("/Filter") != "/DCTDecode"
+        ):
+            continue
+        try:
+            image = Image.open(io.BytesIO(image_object._data))
+        except OSError:
+            continue
+        if image.mode not in ("RGB", "L") or max(image.size) <= max(
+            PDF_EMBED_SETTINGS["max_image_size"]
+        ):
+            continue
+        image.thumbnail(PDF_EMBED_SETTINGS["max_image_size"])
+        output = io.BytesIO()
+        image.save(output, format="JPEG", quality=PDF_EMBED_SETTINGS["quality"])
+        image_object._data = output.getvalue()
+        image_object[NameObject("/Width")] = NumberObject(image.width)
+        image_object[NameObject("/Height")] = NumberObject(image.height)
+
+
+def get_base64_encoded_pdf(file, page_range: tuple = None):
+    """Base64 of the PDF, compacted to page_range when one is given."""
     file.seek(0)
-    pdf_content = file.read()
+    if page_range is None:
+        pdf_content = file.read()
+    else:
+        pdf_reader = PdfReader(file)
+        pdf_writer = PdfWriter()
+        for page_num in range(page_range[0] - 1, page_range[1]):
+            pdf_writer.add_page(pdf_reader.pages[page_num])
+        for page in pdf_writer.pages:
+            if PDF_EMBED_SETTINGS["downsample_images"]:
+                _downsample_page_images(page)
+            page.compress_content_streams()
+        output = io.BytesIO()
+        pdf_writer.write(output)
+        pdf_content = output.getvalue()
     encoded_pdf = base64.b64encode(pdf_content).decode("utf-8")
     return encoded_pdf
 
 
-def get_document_text(file, page_range: tuple = None):
-    file_extension = file.name.split('.')[-1].lower()
-    
-    if file_extension == 'pdf':
+@st.cache_resource
+def _get_ocr_pool():
+    return ProcessPoolExecutor(
+        max_workers=OCR_SETTINGS["max_workers"],
+        mp_context=multiprocessing.get_context("spawn"),
+    )
+
+
+def _submit_ocr(fn, *args):
+    """Submit to the shared OCR pool, replacing the pool once if a worker died."""
+    pool = _get_ocr_pool()
+    try:
+        return pool.submit(fn, *args)
+    except BrokenProcessPool:
+        # Another session may have replaced the broken pool already.
+        if _get_ocr_pool() is pool:
+            _get_ocr_pool.clear()
+        return _get_ocr_pool().submit(fn, *args)
+
+
+def _ocr_result(future, timeout, resubmit):
+    """future.result(), or the result of resubmit() once when its worker died."""
+    try:
+        return future.result(timeout=timeout)
+    except BrokenProcessPool:
+        return resubmit().result(timeout=timeout)
+
+
+def _has_images(page):
+    if "/XObject" not in page["/Resources"]:
+        return False
+    xObject = page["/Resources"]["/XObject"].get_object()
+    return any(xObject[obj]["/Subtype"] == "/Image" for obj in xObject)
+
+
+def _needs_ocr(page_text):
+    """Whether an image page's text layer is too short or garbled to trust."""
+    text = page_text.strip()
+    if len(text) < OCR_SETTINGS["min_text_chars"]:
+        return True
+    # Broken font encodings come out as (cid:NN) runs, U+FFFD or control characters.
+    garbled = sum(len(match) for match in re.findall(r"\(cid:\d+\)", text))
+    garbled += sum(
+        1 for char in text if char == "\ufffd" or not (char.isprintable() or char.isspace())
+    )
+    return garbled / len(text) > OCR_SETTINGS["max_garbled_ratio"]
+
+
+def _ocr_images(images_data, timeout):
+    text = ""
+    for image_data in images_data:
         try:
-            pdf_reader = PdfReader(file)
-        except Exception as e:
-            return f"There was a problem reading the pdf: {str(e)}"
+            image = Image.open(io.BytesIO(image_data))
+        except OSError:
+            continue
+        image_text = pytesseract.image_to_string(image, timeout=timeout)
+        if image_text.strip():
+            text += image_text + "\n"
+    return text
 
-        if page_range is None:
-            first_page = 1
-            last_page = len(pdf_reader.pages)
+
+def _ocr_pages(pdf_path, first_page, last_page, timeout):
+    # One pdftoppm invocation rasterizes the whole run of pages to disk.
+    with tempfile.TemporaryDirectory() as output_folder:
+        images = convert_from_path(
+            pdf_path,
+            dpi=OCR_SETTINGS["dpi"],
+            grayscale=OCR_SETTINGS["grayscale"],
+            first_page=first_page,
+            last_page=last_page,
+            thread_count=OCR_SETTINGS["raster_threads"],
+            output_folder=output_folder,
+            fmt="png",
+        )
+        texts = []
+        for image in images:
+            image_text = pytesseract.image_to_string(image, timeout=timeout)
+            texts.append(image_text + "\n" if image_text.strip() else "")
+            image.close()
+    return texts
+
+
+def _submit_ocr_runs(pdf_path, page_numbers):
+    """Queue OCR of the given 1-based pages, returns {page_number: (run, future)}."""
+    # Contiguous pages are batched into runs, split so every worker gets one.
+    max_run = min(
+        OCR_SETTINGS["max_run_pages"],
+        -(-len(page_numbers) // OCR_SETTINGS["max_workers"]),
+    )
+    runs = []
+    for page_num in page_numbers:
+        if runs and runs[-1][-1] == page_num - 1 and len(runs[-1]) < max_run:
+            runs[-1].append(page_num)
         else:
-            first_page, last_page = page_range
+            runs.append([page_num])
 
-        text = ""
-        for page_num in range(first_page - 1, last_page):
-            page = pdf_reader.pages[page_num]
-            if "/XObject" in page["/Resources"]:
-                xObject = page["/Resources"]["/XObject"].get_object()
-                if any(xObject[obj]["/Subtype"] == "/Image" for obj in xObject):
-                    images = convert_from_bytes(
-                        file.getvalue(), first_page=page_num + 1, last_page=page_num + 1
+    ocr_runs = {}
+    for run in runs:
+        future = _submit_ocr(
+            _ocr_pages, pdf_path, run[0], run[-1], OCR_SETTINGS["page_timeout"]
+        )
+        for page_num in run:
+            ocr_runs[page_num] = (run, future)
+    return ocr_runs
+
+
+def _ocr_run_result(pdf_path, run, future):
+    try:
+        return dict(
+            zip(
+                run,
+                _ocr_result(
+                    future,
+                    OCR_SETTINGS["page_timeout"] * len(run),
+                    lambda: _submit_ocr(
+                        _ocr_pages, pdf_path, run[0], run[-1], OCR_SETTINGS["page_timeout"]
+                    ),
+                ),
+            )
+        )
+    except BrokenProcessPool:
+        st.warning(f"OCR crashed on pages {run[0]}-{run[-1]}, the pages were skipped.")
+        return {}
+    except (FuturesTimeoutError, RuntimeError):
+        future.cancel()
+        st.warning(f"OCR timed out on pages {run[0]}-{run[-1]}, the pages were skipped.")
+        return {}
+
+
+def file_digest(file):
+    return hashlib.sha256(file.getvalue()).hexdigest()
+
+
+def _extract_pdf_pages(file, page_numbers):
+    try:
+        pdf_reader = PdfReader(file)
+    except Exception as e:
+        st.error(f"There was a problem reading the pdf: {str(e)}")
+        st.stop()
+
+    # Pages are classified one window ahead of the consumer, so text-layer pages
+    # are yielded right away and OCR of the next window is already queued while
+    # the current one is consumed.
+    pages = {}
+    ocr_runs = {}
+    image_ocr = {}
+    pdf_path = None
+
+    def classify(window):
+        nonlocal pdf_path
+        ocr_pages = []
+        for page_num in window:
+            page = pdf_reader.pages[page_num - 1]
+            page_text = page.extract_text()
+            if not _has_images(page):
+                pages[page_num] = page_text + "\n"
+            elif _needs_ocr(page_text):
+                ocr_pages.append(page_num)
+            else:
+                pages[page_num] = page_text + "\n"
+                if OCR_SETTINGS["ocr_mode"] == "images":
+                    image_ocr[page_num] = _submit_ocr(
+                        _ocr_images,
+                        [image.data for image in page.images],
+                        OCR_SETTINGS["page_timeout"],
+                    )
+        if ocr_pages:
+            if pdf_path is None:
+                with tempfile.NamedTemporaryFile(suffix=".pdf", delete=False) as pdf_file:
+                    pdf_file.write(file.getvalue())
+                pdf_path = pdf_file.name
+            ocr_runs.update(_submit_ocr_runs(pdf_path, ocr_pages))
+
+    size = OCR_SETTINGS["classify_window"]
+    windows = [page_numbers[i : i + size] for i in range(0, len(page_numbers), size)]
+    classified = 0
+
+    def classify_through(last_window):
+        nonlocal classified
+        while classified <= min(last_window, len(windows) - 1):
+            classify(windows[classified])
+            classified += 1
+
+    try:
+        ocr_texts = {}
+        classify_through(0)
+        for w, window in enumerate(windows):
+            for page_num in window:
+                if page_num in pages and page_num not in image_ocr:
+                    yield page_num, pages[page_num]
+                    continue
+                # About to wait on OCR, queue the next window first.
+                classify_through(w + 1)
+                if page_num in ocr_runs:
+                    if page_num not in ocr_texts:
+                        run, future = ocr_runs[page_num]
+                        ocr_texts.update(dict.fromkeys(run))
+                        ocr_texts.update(_ocr_run_result(pdf_path, run, future))
+                    yield page_num, ocr_texts[page_num]
+                    continue
+                try:
+                    image_text = _ocr_result(
+                        image_ocr[page_num],
+                        OCR_SETTINGS["page_timeout"],
+                        lambda: _submit_ocr(
+                            _ocr_images,
+                            [image.data for image in pdf_reader.pages[page_num - 1].images],
+                            OCR_SETTINGS["page_timeout"],
+                        ),
                     )
-                    for image in images:
-                        image_text = pytesseract.image_to_string(image)
-                        if image_text.strip():
-                            text += image_text + "\n"
+                except BrokenProcessPool:
+                    st.warning(f"OCR crashed on the images of page {page_num}.")
+                    yield page_num, None
+                except (FuturesTimeoutError, RuntimeError):
+                    image_ocr[page_num].cancel()
+                    st.warning(f"OCR timed out on the images of page {page_num}.")
+                    yield page_num, None
                 else:
-                    text += page.extract_text() + "\n"
-            else:
-                text += page.extract_text() + "\n"
-        return text
+                    yield page_num, pages[page_num] + image_text
+            classify_through(w + 1)
+    finally:
+        # Don't leave this extraction's queued OCR on the shared pool when the
+        # consumer stops early.
+        for _, future in ocr_runs.values():
+            future.cancel()
+        for future in image_ocr.values():
+            future.cancel()
+        if pdf_path is not None:
+            os.remove(pdf_path)
 
-    elif file_extension == 'pptx':
-        try:
-            presentation = Presentation(file)
-        except Exception as e:
-            return f"There was a problem reading the pptx: {str(e)}"
 
-        if page_range is None:
-            first_slide = 1
-            last_slide = len(presentation.slides)
-        else:
-            first_slide, last_slide = page_range
+def _extract_pptx_pages(file, page_numbers):
+    try:
+        presentation = Presentation(file)
+    except Exception as e:
+        st.error(f"There was a problem reading the pptx: {str(e)}")
+        st.stop()
 
+    for slide_num in page_numbers:
+        slide = presentation.slides[slide_num - 1]
         text = ""
-        for slide_num in range(first_slide - 1, last_slide):
-            slide = presentation.slides[slide_num]
-            for shape in slide.shapes:
-                if hasattr(shape, "text"):
-                    text += shape.text + "\n"
-        return text
+        for shape in slide.shapes:
+            if hasattr(shape, "text"):
+                text += shape.text + "\n"
+        yield slide_num, text
 
-    elif file_extension == 'docx':
-        try:
-            document = Document(file)
-        except Exception as e:
-            st.error(f"There was a problem reading the docx: {str(e)}")
-            st.stop()
-        text = ""
-        for paragraph in document.paragraphs:
-            text += paragraph.text + "\n"
-        return text
 
-    else:
+def _extract_docx_pages(file, page_numbers):
+    try:
+        document = Document(file)
+    except Exception as e:
+        st.error(f"There was a problem reading the docx: {str(e)}")
+        st.stop()
+    yield 1, "".join(paragraph.text + "\n" for paragraph in document.paragraphs)
+
+
+PAGE_EXTRACTORS = {
+    "pdf": _extract_pdf_pages,
+    "pptx": _extract_pptx_pages,
+    "docx": _extract_docx_pages,
+}
+
+
+def iter_document_pages(file, page_range: tuple = None, failed: list = None):
+    """Yield (page_number, text) in page order, as soon as each page is ready.
+
+    Pages that failed to extract are yielded as "" and appended to failed.
+    """
+    file_extension = file.name.split('.')[-1].lower()
+    if file_extension not in PAGE_EXTRACTORS:
         st.write("Unsupported file type")
         st.stop()
 
+    if page_range is None:
+        first_page, last_page = 1, page_count(file)
+    else:
+        first_page, last_page = page_range
+
+    # Pages are cached by upload hash, so a wider slider only extracts new pages.
+    cache = get_cache("page_text")
+    digest = file_digest(file)
+    settings = [OCR_SETTINGS[key] for key in EXTRACTION_SETTINGS]
+    keys = {
+        page_num: cache_key(digest, page_num, settings)
+        for page_num in range(first_page, last_page + 1)
+    }
+    pages = {}
+    for page_num, key in keys.items():
+        page_text = cache.get(key)
+        if page_text is not None:
+            pages[page_num] = page_text
+    missing = [page_num for page_num in keys if page_num not in pages]
+    extracted = PAGE_EXTRACTORS[file_extension](file, missing) if missing else None
+
+    for page_num, key in keys.items():
+        if page_num in pages:
+            yield page_num, pages[page_num]
+            continue
+        _, page_text = next(extracted)
+        # Pages that failed to OCR come back as None and are not cached.
+        if page_text is not None:
+            cache.set(key, page_text)
+        elif failed is not None:
+            failed.append(page_num)
+        yield page_num, page_text or ""
+
+
+def get_document_text(file, page_range: tuple = None):
+    return "".join(text for _, text in iter_document_pages(file, page_range))
+
 def fetch_transcript(url):
     if "watch?v=" in url:
         video_id = url.split("watch?v=")[1].split("&")[0]
@@ -391,24 +1708,29 @@ def fetch_transcript(url):
 def page_count(document):
     """Extract the number of pages in a document (PDF, DOCX, PPTX)."""
     file_extension = document.name.split('.')[-1].lower()
-    
+    if file_extension not in PAGE_EXTRACTORS:
+        st.error("Unsupported file type")
+        st.stop()
+
     try:
-        if file_extension == 'pdf':
-            pdf_reader = PdfReader(document)
-            return len(pdf_reader.pages)
-        elif file_extension == 'docx':
-            return 1
-        elif file_extension == 'pptx':
-            presentation = Presentation(document)
-            return len(presentation.slides)
-        else:
-            st.error("Unsupported file type")
-            st.stop()
+        return _page_count(file_digest(document), file_extension, document)
     except Exception as e:
         st.error(f"Error reading the {file_extension.upper()} file: {str(e)}")
         st.stop()
 
 
+@st.cache_data(max_entries=64, show_spinner=False)
+def _page_count(digest, file_extension, _document):
+    if file_extension == 'pdf':
+        pdf_reader = PdfReader(_document)
+        return len(pdf_reader.pages)
+    elif file_extension == 'docx':
+        return 1
+    elif file_extension == 'pptx':
+        presentation = Presentation(_document)
+        return len(presentation.slides)
+
+
 def clean_flashcards(flashcards):
     unwanted_headers_col1 = {"question", "questions", "term", "terms"}
     unwanted_headers_col2 = {"answer", "answers", "definition", "definitions"}
@@ -484,14 +1806,59 @@ def display_flashcards(flashcards):
         st.write(f"Answer: {answer}")
 
 
+def _load_studykit_template():
+    # Split once on the ***placeholder*** markers: even items are static
+    # HTML, odd items are placeholder names.
+    with open(
+        os.path.join(os.path.dirname(os.path.abspath(__file__)), "NoteCraft-StudyKit.html"),
+        "r",
+    ) as file:
+        return re.split(r"\*\*\*(.+?)\*\*\*", file.read())
+
+
+STUDYKIT_TEMPLATE = _load_studykit_template()
+
+
+def render_studykit(markdown_content, flashcards, encoded_pdf, page_range):
+    """Fill the StudyKit template in a single join over its segments."""
+    values = {
+        "markdown_content": markdown_content,
+        "flashcards": flashcards,
+        "encoded_pdf": encoded_pdf,
+        "page_range[0]": str(page_range[0]),
+        "page_range[1]": str(page_range[1]),
+    }
+    return "".join(
+        values[segment] if i % 2 else segment
+        for i, segment in enumerate(STUDYKIT_TEMPLATE)
+    )
+
+
 def parse_studkit(content):
     note = re.search(r"note=`\^(.*?)`\^", content, re.DOTALL).group(1)
     flashcards = re.search(r"flashcards=`\^(.*?)`\^", content, re.DOTALL).group(1)
     return note, flashcards
 
 
-def paper(header_text, markdown_text=None, flashcards=None):
-    styles = """
+def paper_download_button(
+    label, file_name, header_text, markdown_text=None, flashcards=None
+):
+    """Download button for utils.paper that renders only once the user asks for it."""
+    content_key = cache_key(header_text, markdown_text, flashcards)
+    if st.session_state.get(f"paper_ready_{label}") != content_key:
+        if not st.button(label.replace("Download", "Prepare"), use_container_width=True):
+            return
+        st.session_state[f"paper_ready_{label}"] = content_key
+    st.download_button(
+        label=label,
+        data=paper(header_text, markdown_text=markdown_text, flashcards=flashcards),
+        file_name=file_name,
+        mime="application/pdf",
+        use_container_width=True,
+    )
+
+
+PAPER_STYLES = """
 body { font-family: serif; }
 h1 { text-align: center; font-size: 36px; }
 .page-headers { text-align: center; font-size: 24px; margin-bottom: 25px; }
@@ -510,98 +1877,137 @@ code { font-family: 'Courier New', Courier, monospace; }
 .questions li { padding-bottom: 150px; }
 .answers li { margin-bottom: 15px; }
 """
-    cover_html = f"""
+
+PAPER_PDF_OPTIONS = {
+    "page-size": "A4",
+    "margin-top": "2cm",
+    "margin-right": "2cm",
+    "margin-bottom": "2cm",
+    "margin-left": "2cm",
+    "encoding": "UTF-8",
+    "no-outline": None,
+}
+
+# Every wkhtmltopdf job of the server goes through this pool, so at most
+# max_workers renderers run at once and the rest wait in its queue.
+PAPER_SETTINGS = {"max_workers": min(4, os.cpu_count() or 1)}
+
+
+@functools.lru_cache(maxsize=None)
+def _get_paper_pool():
+    return ThreadPoolExecutor(max_workers=PAPER_SETTINGS["max_workers"])
+
+
+def _paper_html(title, body, styles):
+    return f"""
     <html>
     <head>
-        <title>Cover Page</title>
+        <title>{title}</title>
         <style>
             {styles}
         </style>
     </head>
     <body>
-        <h1 class="cover_page_title">{header_text}</h1>
-        <p style="text-align: center; font-size: 24px;">Crafted by <a href="https://notecraft.streamlit.app/">NoteCraft</a></p>
-        <p style="text-align: center; font-size: 24px;"><svg xmlns="http://www.w3.org/2000/svg" width="25" height="25" fill="currentColor" class="bi bi-github" viewBox="0 0 16 16">
-  <path d="M8 0C3.58 0 0 3.58 0 8c0 3.54 2.29 6.53 5.47 7.59.4.07.55-.17.55-.38 0-.19-.01-.82-.01-1.49-2.01.37-2.53-.49-2.69-.94-.09-.23-.48-.94-.82-1.13-.28-.15-.68-.52-.01-.53.63-.01 1.08.58 1.23.82.72 1.21 1.87.87 2.33.66.07-.52.28-.87.51-1.07-1.78-.2-3.64-.89-3.64-3.95 0-.87.31-1.59.82-2.15-.08-.2-.36-1.02.08-2.12 0 0 .67-.21 2.2.82.64-.18 1.32-.27 2-.27s1.36.09 2 .27c1.53-1.04 2.2-.82 2.2-.82.44 1.1.16 1.92.08 2.12.51.56.82 1.27.82 2.15 0 3.07-1.87 3.75-3.65 3.95.29.25.54.73.54 1.48 0 1.07-.01 1.93-.01 2.2 0 .21.15.46.55.38A8.01 8.01 0 0 0 16 8c0-4.42-3.58-8-8-8"/></svg> GitHub repo: https://github.com/AL-Sayed1/NoteCraft</p>
+        {body}
     </body>
     </html>
     """
 
-    html_text = ""
-    if markdown_text:
-        html_text = (
-            "<div style='page-break-after: always;'></div> <h1 class='.page-headers'>Notes:</h1>"
-            + markdown.markdown(
-                markdown_text,
-                extensions=[
-                    "tables",
-                    "fenced_code",
-                    "attr_list",
-                    "toc",
-                    "footnotes",
-                    "codehilite",
-                    "meta",
-                ],
-            )
+
+def _render_pdf(html):
+    return pdfkit.from_string(html, False, options=PAPER_PDF_OPTIONS)
+
+
+@functools.lru_cache(maxsize=32)
+def _cover_pdf(header_text, styles):
+    return _render_pdf(
+        _paper_html(
+            "Cover Page",
+            f"""<h1 class="cover_page_title">{header_text}</h1>
+        <p style="text-align: center; font-size: 24px;">Crafted by <a href="https://notecraft.streamlit.app/">NoteCraft</a></p>
+        <p style="text-align: center; font-size: 24px;"><svg xmlns="http://www.w3.org/2000/svg" width="25" height="25" fill="currentColor" class="bi bi-github" viewBox="0 0 16 16">
+  <path d="M8 0C3.58 0 0 3.58 0 8c0 3.54 2.29 6.53 5.47 7.59.4.07.55-.17.55-.38 0-.19-.01-.82-.01-1.49-2.01.37-2.53-.49-2.69-.94-.09-.23-.48-.94-.82-1.13-.28-.15-.68-.52-.01-.53.63-.01 1.08.58 1.23.82.72 1.21 1.87.87 2.33.66.07-.52.28-.87.51-1.07-1.78-.2-3.64-.89-3.64-3.95 0-.87.31-1.59.82-2.15-.08-.2-.36-1.02.08-2.12 0 0 .67-.21 2.2.82.64-.18 1.32-.27 2-.27s1.36.09 2 .27c1.53-1.04 2.2-.82 2.2-.82.44 1.1.16 1.92.08 2.12.51.56.82 1.27.82 2.15 0 3.07-1.87 3.75-3.65 3.95.29.25.54.73.54 1.48 0 1.07-.01 1.93-.01 2.2 0 .21.15.46.55.38A8.01 8.01 0 0 0 16 8c0-4.42-3.58-8-8-8"/></svg> GitHub repo: https://github.com/AL-Sayed1/NoteCraft</p>""",
+            styles,
         )
+    )
+
 
+@functools.lru_cache(maxsize=16)
+def _notes_html(markdown_text, styles):
+    return _paper_html(
+        "Notes",
+        "<h1 class='.page-headers'>Notes:</h1>"
+        + markdown.markdown(
+            markdown_text,
+            extensions=[
+                "tables",
+                "fenced_code",
+                "attr_list",
+                "toc",
+                "footnotes",
+                "codehilite",
+                "meta",
+            ],
+        ),
+        styles,
+    )
+
+
+@functools.lru_cache(maxsize=16)
+def _flashcards_html(flashcards, styles):
     questions_html = ""
     answers_html = ""
+    flashcards_reader = csv.reader(
+        clean_flashcards(flashcards).splitlines(), delimiter="\t"
+    )
+    for row in flashcards_reader:
+        if len(row) == 2:
+            question, answer = row
+            questions_html += f"<li>{question}</li>"
+            answers_html += f"<li>{answer}</li>"
+        else:
+            questions_html += f"<li>Invalid question format: {' '.join(row)}</li>"
+            answers_html += f"<li>Invalid answer format: {' '.join(row)}</li>"
+
+    return (
+        _paper_html(
+            "Questions",
+            f"""<h1 class='page-headers'>Questions</h1>
+            <ol class="questions">{questions_html}</ol>""",
+            styles,
+        ),
+        _paper_html(
+            "Answer Key",
+            f"""<h1 class='page-headers'>Answer Key</h1>
+            <ol class="answers">{answers_html}</ol>""",
+            styles,
+        ),
+    )
+
+
+def paper(header_text, markdown_text=None, flashcards=None):
+    return _paper(header_text, markdown_text, flashcards, PAPER_STYLES)
+
+
+# Memoized by the hash of its arguments, styles included, so reruns reuse
+# the PDF until the content changes.
+@st.cache_data(max_entries=8, show_spinner="Rendering the PDF...")
+def _paper(header_text, markdown_text, flashcards, styles):
+    # Sections render in parallel on the shared pool and are merged in order.
+    pool = _get_paper_pool()
+    sections = [pool.submit(_cover_pdf, header_text, styles)]
+    if markdown_text:
+        sections.append(pool.submit(_render_pdf, _notes_html(markdown_text, styles)))
     if flashcards:
-        questions_html = f"""
-        <div style='page-break-after: always;'></div>
-        <html>
-        <head>
-            <title>Questions</title>
-            <style>
-                {styles}
-            </style>
-        </head>
-        <body>
-            <h1 class='page-headers'>Questions</h1>
-            <ol class="questions">
-        """
-        answers_html = f"""
-        <div style='page-break-after: always;'></div>
-        <html>
-        <head>
-            <title>Answer Key</title>
-            <style>
-                {styles}
-            </style>
-        </head>
-        <body>
-            <h1 class='page-headers'>Answer Key</h1>
-            <ol class="answers">
-        """
-
-        flashcards_reader = csv.reader(
-            clean_flashcards(flashcards).splitlines(), delimiter="\t"
+        sections.extend(
+            pool.submit(_render_pdf, html)
+            for html in _flashcards_html(flashcards, styles)
         )
-        for row in flashcards_reader:
-            if len(row) == 2:
-                question, answer = row
-                questions_html += f"<li>{question}</li>"
-                answers_html += f"<li>{answer}</li>"
-            else:
-                questions_html += f"<li>Invalid question format: {' '.join(row)}</li>"
-                answers_html += f"<li>Invalid answer format: {' '.join(row)}</li>"
-
-        questions_html += "</ol></body></html>"
-        answers_html += "</ol></body></html>"
-
-    full_html = cover_html + html_text + questions_html + answers_html
-    pdf_data = pdfkit.from_string(
-        full_html,
-        False,
-        options={
-            "page-size": "A4",
-            "margin-top": "2cm",
-            "margin-right": "2cm",
-            "margin-bottom": "2cm",
-            "margin-left": "2cm",
-            "encoding": "UTF-8",
-            "no-outline": None,
-        },
-    )
-    return pdf_data
+
+    pdf_writer = PdfWriter()
+    for section in sections:
+        for page in PdfReader(io.BytesIO(section.result())).pages:
+            pdf_writer.add_page(page)
+    output = io.BytesIO()
+    pdf_writer.write(output)
+    return output.getvalue()